@@ -1,20 +1,76 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import psycopg2
+from psycopg2.extras import execute_batch
+import orjson
 import yaml
+# The C loader needs PyYAML built against libyaml (libyaml-dev at build time)
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 import urllib.parse as urlparse
 import re
+import functools
+import itertools
+from dotenv import load_dotenv
+import io
+import struct
+import datetime
+import os
+import json
+import tempfile
+import queue
+import threading
+import time
+import multiprocessing
+from multiprocessing.util import Finalize
+from concurrent.futures import ProcessPoolExecutor
 
-# Load environment variables into a dictionary
-with open('.env') as env_file:
-    env_vars = dict(line.strip().split('=') for line in env_file if line.strip() and not line.startswith('#'))
+# Load environment variables from .env
+load_dotenv()
 
-# Load mapping configuration from config.yaml
-with open('config.yaml') as file:
-    config = yaml.safe_load(file)
+CONFIG_PATH = 'config.yaml'
+CONFIG_CACHE_PATH = 'config.yaml.cache.json'
+
+# Load mapping configuration from config.yaml, via a JSON cache kept next to it.
+# The cache records the mtime and size of the YAML it was built from, so a
+# config.yaml copied with its timestamp preserved still invalidates it
+def _load_config():
+    stat = os.stat(CONFIG_PATH)
+    source = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+    try:
+        with open(CONFIG_CACHE_PATH) as cache_file:
+            cached = json.load(cache_file)
+        if cached.get('source') == source:
+            return cached['config']
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+
+    with open(CONFIG_PATH) as file:
+        loaded = yaml.load(file, Loader=SafeLoader)
+
+    # Write the cache atomically so a concurrent run never reads a partial file.
+    # The cache is only an optimisation: if it can't be written (read-only
+    # checkout, values JSON can't hold) the parsed YAML is used as is
+    tmp_path = None
+    try:
+        cache_dir = os.path.dirname(os.path.abspath(CONFIG_CACHE_PATH))
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump({'source': source, 'config': loaded}, tmp_file)
+        os.replace(tmp_path, CONFIG_CACHE_PATH)
+    except (OSError, TypeError, ValueError):
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return loaded
+
+config = _load_config()
 
 # Airtable API configuration
-AIRTABLE_API_KEY = env_vars.get('AIRTABLE_API_KEY')
-AIRTABLE_BASE_ID = env_vars.get('AIRTABLE_BASE_ID')
+AIRTABLE_API_KEY = os.environ.get('AIRTABLE_API_KEY')
+AIRTABLE_BASE_ID = os.environ.get('AIRTABLE_BASE_ID')
 
 HEADERS = {
     'Authorization': f'Bearer {AIRTABLE_API_KEY}'
@@ -22,123 +78,385 @@ HEADERS = {
 
 # Hasura Postgres database configuration
 HASURA_DB = {
-    'dbname': env_vars.get('HASURA_DB_NAME'),
-    'user': env_vars.get('HASURA_DB_USER'),
-    'password': env_vars.get('HASURA_DB_PASSWORD'),
-    'host': env_vars.get('HASURA_DB_HOST'),
-    'port': env_vars.get('HASURA_DB_PORT')
+    'dbname': os.environ.get('HASURA_DB_NAME'),
+    'user': os.environ.get('HASURA_DB_USER'),
+    'password': os.environ.get('HASURA_DB_PASSWORD'),
+    'host': os.environ.get('HASURA_DB_HOST'),
+    'port': os.environ.get('HASURA_DB_PORT')
 }
 
+# Maximum number of tables migrated at the same time. Each worker process
+# holds one Postgres connection, so keep this well under max_connections.
+# Airtable requests are rate limited across all workers, see below
+TABLE_WORKERS = 8
+
+# Retry settings for rate-limited (429) and transient server errors from Airtable.
+# After a 429 Airtable rejects requests for 30 seconds; backing off 0, 4, 8, 16,
+# 32 and 64 seconds keeps retrying for about two minutes, well past that penalty
+MAX_RETRIES = 6
+RETRY_BACKOFF_FACTOR = 2
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+# (connect, read) timeout in seconds for each Airtable request, so a stalled
+# connection is retried or fails instead of hanging a worker mid-transaction
+REQUEST_TIMEOUT = (10, 60)
+
+# Airtable allows 5 requests per second per base. Every worker process takes
+# its request slots from one shared clock so the total stays under that
+AIRTABLE_REQUESTS_PER_SECOND = 4
+_next_request_at = multiprocessing.Value('d', 0.0)
+
+# How long Airtable rejects every request to a base after a 429
+AIRTABLE_RATE_LIMIT_PENALTY_SECONDS = 30
+
+# Block until this process may send its next Airtable request
+def _wait_for_request_slot():
+    with _next_request_at.get_lock():
+        now = time.time()
+        slot = max(now, _next_request_at.value)
+        _next_request_at.value = slot + 1 / AIRTABLE_REQUESTS_PER_SECOND
+    time.sleep(slot - now)
+
+# Hold back every worker's requests until the rate-limit penalty has passed
+def _defer_requests(seconds):
+    with _next_request_at.get_lock():
+        _next_request_at.value = max(_next_request_at.value, time.time() + seconds)
+
+# urllib3 sends retries itself, so make them wait for the shared limiter too
+class _RateLimitedRetry(Retry):
+    def sleep(self, response=None):
+        if response is not None and response.status == 429:
+            _defer_requests(AIRTABLE_RATE_LIMIT_PENALTY_SECONDS)
+        super().sleep(response)
+        _wait_for_request_slot()
+
+# Airtable session: keep-alive connections reused across pages, with
+# retries that back off exponentially and honour Retry-After
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount('https://', HTTPAdapter(
+    max_retries=_RateLimitedRetry(total=MAX_RETRIES, backoff_factor=RETRY_BACKOFF_FACTOR,
+                                  status_forcelist=RETRY_STATUS_CODES),
+))
+
+# Maximum number of fetched pages buffered per table before the fetch waits on the inserts
+PAGE_QUEUE_SIZE = 4
+
+# Number of records sent to Postgres in each COPY
+COPY_BATCH_SIZE = 1000
+
+# Load rows with COPY. Set to False where COPY is unavailable (e.g. behind a
+# proxy that rejects it) to use a server-side prepared INSERT instead
+USE_COPY = True
+
+# Seconds to wait for a table's producer thread to finish once the table is done
+PRODUCER_JOIN_TIMEOUT = 1
+
+# Placed on a page queue once all of a table's pages have been fetched
+_END_OF_PAGES = None
+
+_SNAKE_RE = re.compile(r'(?<!^)(?=[A-Z])')
+
+@functools.lru_cache(maxsize=256)
 def to_snake_case(name):
     # Remove spaces and convert to snake case
     name_no_spaces = name.replace(' ', '')
-    return re.sub(r'(?<!^)(?=[A-Z])', '_', name_no_spaces).lower()
+    return _SNAKE_RE.sub('_', name_no_spaces).lower()
+
+# Binary COPY framing: signature, flags and header extension length, then a -1 field count trailer
+_BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_BINARY_COPY_TRAILER = struct.pack('!h', -1)
+_BINARY_NULL = struct.pack('!i', -1)
+_PG_EPOCH = datetime.date(2000, 1, 1)
+
+def _encode_text(value):
+    return _to_text(value).encode('utf-8')
+
+def _encode_boolean(value):
+    # Only real booleans; strings like 'false' are left for Postgres to parse
+    if not isinstance(value, bool):
+        raise ValueError(f'not a boolean: {value!r}')
+    return b'\x01' if value else b'\x00'
+
+# YYYY-MM-DD on its own, or as the date part of an ISO timestamp
+_ISO_DATE_RE = re.compile(r'([0-9]{4}-[0-9]{2}-[0-9]{2})(?:T.*)?', re.DOTALL)
+
+def _encode_date(value):
+    # Airtable sends ISO dates, and ISO timestamps for date-time fields. Anything
+    # else raises ValueError and the batch is sent as text COPY instead
+    match = _ISO_DATE_RE.fullmatch(value) if isinstance(value, str) else None
+    if not match:
+        raise ValueError(f'not an ISO date: {value!r}')
+    days = (datetime.date.fromisoformat(match.group(1)) - _PG_EPOCH).days
+    return struct.pack('!i', days)
+
+# Binary COPY encoders for column types; tables using any other type use text COPY
+_BINARY_ENCODERS = {
+    'TEXT': _encode_text,
+    'BOOLEAN': _encode_boolean,
+    'DATE': _encode_date,
+}
+
+# Validate a table's config mapping and build its SQL and column order once
+def _build_table_plan(table_name, mapping):
+    if not mapping:
+        raise ValueError(f'Mapping not found for table: {table_name}')
+    for airtable_field, postgres_field in mapping.items():
+        if not isinstance(postgres_field, dict) or 'name' not in postgres_field or 'type' not in postgres_field:
+            raise ValueError(f'Field {airtable_field} in table {table_name} needs a name and a type')
+
+    snake = to_snake_case(table_name)
+    cols = tuple(postgres_field['name'] for postgres_field in mapping.values())
+    types = tuple(postgres_field['type'] for postgres_field in mapping.values())
+    column_defs = ', '.join(f'{name} {type_}' for name, type_ in zip(cols, types))
+    column_list = ', '.join(cols)
+    statement = f'ins_{snake}'
+    binary_encoders = None
+    if all(type_.strip().upper() in _BINARY_ENCODERS for type_ in types):
+        binary_encoders = tuple(_BINARY_ENCODERS[type_.strip().upper()] for type_ in types)
+    return {
+        'table_name': table_name,
+        'snake': snake,
+        'fields': tuple(mapping.keys()),
+        'cols': cols,
+        'types': types,
+        'create_sql': f'CREATE TABLE IF NOT EXISTS {snake} (id UUID PRIMARY KEY DEFAULT uuid_generate_v4(), {column_defs})',
+        'drop_sql': f'DROP TABLE IF EXISTS {snake}',
+        'recreate_sql': f'CREATE TABLE {snake} (id UUID PRIMARY KEY DEFAULT gen_random_uuid(), {column_defs})',
+        'binary_encoders': binary_encoders,
+        'copy_sql': f'COPY {snake} ({column_list}) FROM STDIN WITH (FORMAT text)',
+        'binary_copy_sql': f'COPY {snake} ({column_list}) FROM STDIN WITH (FORMAT binary)',
+        'prepare_sql': (f"PREPARE {statement} ({', '.join(types)}) AS INSERT INTO {snake} ({column_list}) "
+                        f"VALUES ({', '.join(f'${i}' for i in range(1, len(cols) + 1))})"),
+        'execute_sql': f"EXECUTE {statement} ({', '.join('%s' for _ in cols)})",
+    }
+
+# Built at import so a bad config.yaml fails before anything is fetched or dropped
+TABLE_PLANS = {table_name: _build_table_plan(table_name, mapping) for table_name, mapping in config['tables'].items()}
 
-# Get data from Airtable
-def get_airtable_data(table_name):
+# The worker process's Postgres connection, opened once by _init_worker
+_conn = None
+
+# Set up a worker process: use the parent's shared request clock and open the
+# one Postgres connection the worker reuses for every table it migrates
+def _init_worker(next_request_at):
+    global _next_request_at, _conn
+    _next_request_at = next_request_at
+
+    _conn = psycopg2.connect(**HASURA_DB)
+    _conn.autocommit = False
+    # Binary COPY sends TEXT values as UTF-8 bytes, which Postgres reads in the
+    # client encoding, so the two must match
+    _conn.set_client_encoding('UTF8')
+    Finalize(None, _conn.close, exitpriority=0)
+
+    # Enable the uuid-ossp extension if it doesn't exist. The advisory lock makes
+    # the workers take turns, since concurrent CREATE EXTENSION statements can conflict
+    with _conn:
+        with _conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('airtable-hasura-etl uuid-ossp'))")
+            cur.execute('CREATE EXTENSION IF NOT EXISTS "uuid-ossp";')
+
+# Get data from Airtable, one page of records at a time
+def iter_airtable_pages(table_name):
     url = f'https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{table_name}'
-    records = []
     offset = None
     while True:
         params = {}
         if offset:
             params['offset'] = offset
-        response = requests.get(url, headers=HEADERS, params=params)
-        data = response.json()
-        records.extend(data['records'])
+        _wait_for_request_slot()
+        response = SESSION.get(url, params=params, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        # Airtable responses are UTF-8, so orjson can parse the raw bytes directly
+        data = orjson.loads(response.content)
+        yield data['records']
         if 'offset' not in data:
             break
         offset = data['offset']
-    return records
 
-# Transform data based on the mapping configuration
-def transform_data(table_name, records):
-    transformed_records = []
-    mapping = config['tables'].get(table_name)
-    if not mapping:
-        raise ValueError(f'Mapping not found for table: {table_name}')
+# Put an item on a page queue, giving up once the migration has been stopped
+def _put_page(page_queue, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            page_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
 
-    for record in records:
-        transformed = {}
-        for airtable_field, postgres_field in mapping.items():
-            transformed[postgres_field['name']] = record['fields'].get(airtable_field)
-        transformed_records.append(transformed)
-    return transformed_records
+# Producer: fetch a table's pages from Airtable onto its queue
+def _produce_pages(table_name, page_queue, stop_event):
+    try:
+        for page in iter_airtable_pages(table_name):
+            if not _put_page(page_queue, page, stop_event):
+                return
+        _put_page(page_queue, _END_OF_PAGES, stop_event)
+    except Exception as e:
+        # Hand the error to the consumer so the insert is rolled back
+        _put_page(page_queue, e, stop_event)
+
+# Consumer: yield pages from a table's queue until its producer is done
+def _drain_pages(page_queue):
+    while True:
+        page = page_queue.get()
+        if page is _END_OF_PAGES:
+            return
+        if isinstance(page, Exception):
+            raise page
+        yield page
+
+# Transform data based on the mapping configuration
+# Returns the Postgres column names and one list of values per column
+def transform_data(plan, records):
+    # Look up each record's fields once rather than once per column
+    record_fields = [record['fields'] for record in records]
+    column_values = [[fields.get(airtable_field) for fields in record_fields] for airtable_field in plan['fields']]
+    return plan['cols'], column_values
 
 # Create tables if they don't exist
-def create_table_if_not_exists(table_name):
-    snake_case_table_name = to_snake_case(table_name)
-    mapping = config['tables'].get(table_name)
-    if not mapping:
-        raise ValueError(f'Mapping not found for table: {table_name}')
+def create_table_if_not_exists(conn, plan):
+    print(f"Creating table if not exists: {plan['table_name']}")
 
-    print(f'Creating table if not exists: {table_name}')
+    with conn.cursor() as cur:
+        cur.execute(plan['create_sql'])
+
+# Split a record iterator into lists of at most size records
+def _chunked(records, size):
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield chunk
 
-    columns = ', '.join([f"{postgres_field['name']} {postgres_field['type']}" for postgres_field in mapping.values()])
-    create_query = f'CREATE TABLE IF NOT EXISTS {snake_case_table_name} (id UUID PRIMARY KEY DEFAULT uuid_generate_v4(), {columns})'
-    conn = psycopg2.connect(**HASURA_DB)
-    cur = conn.cursor()
+# Quote a single element of a Postgres array literal when needed
+def _array_element(value):
+    if value is None:
+        return 'NULL'
+    text = _to_text(value)
+    if text == '' or text.upper() == 'NULL' or any(ch in text for ch in '{}," \\\t\n\r'):
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return text
+
+# Render a Python value the way Postgres would store it in a TEXT column.
+# Airtable objects (attachments, collaborators, buttons) arrive as dicts and
+# are rejected, as psycopg2 did, rather than stored as Python reprs
+def _to_text(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, list):
+        return '{' + ','.join(_array_element(item) for item in value) + '}'
+    if isinstance(value, (str, int, float)):
+        return str(value)
+    raise TypeError(f"can't load {type(value).__name__} value into Postgres: {value!r}")
+
+# Escape a value for the COPY text format
+def _escape(value):
+    if value is None:
+        return '\\N'
+    return (_to_text(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+# Send a batch of columnar values to Postgres with a single COPY
+def _copy_columns(cur, copy_query, column_values):
+    buf = io.StringIO()
+    for row in zip(*column_values):
+        buf.write('\t'.join(map(_escape, row)) + '\n')
+    buf.seek(0)
+    cur.copy_expert(copy_query, buf)
+
+# Encode a batch of columnar values in the binary COPY format
+def _binary_copy_buffer(encoders, column_values):
+    buf = io.BytesIO()
+    buf.write(_BINARY_COPY_HEADER)
+    field_count = struct.pack('!h', len(encoders))
+    for row in zip(*column_values):
+        buf.write(field_count)
+        for encode, value in zip(encoders, row):
+            if value is None:
+                buf.write(_BINARY_NULL)
+            else:
+                data = encode(value)
+                buf.write(struct.pack('!i', len(data)))
+                buf.write(data)
+    buf.write(_BINARY_COPY_TRAILER)
+    buf.seek(0)
+    return buf
+
+# Send a batch of columnar values to Postgres with a single binary COPY, or
+# with text COPY when a value only Postgres can parse (e.g. a 1/2/2024 date)
+# can't be encoded
+def _copy_columns_binary(cur, plan, column_values):
     try:
-        # Enable the uuid-ossp extension if it doesn't exist
-        cur.execute('CREATE EXTENSION IF NOT EXISTS "uuid-ossp";')
-        cur.execute(create_query)
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise e
-    finally:
-        cur.close()
-        conn.close()
+        buf = _binary_copy_buffer(plan['binary_encoders'], column_values)
+    except ValueError:
+        _copy_columns(cur, plan['copy_sql'], column_values)
+        return
+    cur.copy_expert(plan['binary_copy_sql'], buf)
 
 # Insert data into Hasura Postgres database
-def insert_into_postgres(table_name, records, drop_table_before_insert=False):
-    print(f'Migrating table: {table_name}')
-    snake_case_table_name = to_snake_case(table_name)
-    
-    # Get column mapping from config
-    mapping = config['tables'].get(table_name)
-    if not mapping:
-        raise ValueError(f'Mapping not found for table: {table_name}')
-    
-    columns = [postgres_field['name'] for postgres_field in mapping.values()]
-    column_list = ', '.join(columns)
-    placeholders = ', '.join(['%s' for _ in columns])
-    insert_query = f'INSERT INTO {snake_case_table_name} ({column_list}) VALUES ({placeholders})'
-
-    conn = psycopg2.connect(**HASURA_DB)
-    cur = conn.cursor()
-    try:
+def insert_into_postgres(conn, plan, batches, drop_table_before_insert=False):
+    print(f"Migrating table: {plan['table_name']}")
+
+    with conn.cursor() as cur:
         if drop_table_before_insert:
             # Drop the table if it exists
-            print(f'Dropping table: {snake_case_table_name}')
-            drop_table_query = f'DROP TABLE IF EXISTS {snake_case_table_name}'
-            cur.execute(drop_table_query)
+            print(f"Dropping table: {plan['snake']}")
+            cur.execute(plan['drop_sql'])
 
             # Create the table again
-            create_columns = ', '.join([f"{postgres_field['name']} {postgres_field['type']}" for postgres_field in mapping.values()])
-            create_query = f'CREATE TABLE {snake_case_table_name} (id UUID PRIMARY KEY DEFAULT gen_random_uuid(), {create_columns})'
-            cur.execute(create_query)
+            cur.execute(plan['recreate_sql'])
 
-        # Insert records into the table
-        for record in records:
-            cur.execute(insert_query, tuple(record.values()))
+        if USE_COPY:
+            # Stream each batch into the table with COPY as it arrives, in binary
+            # format when every column type has an encoder
+            for _columns, column_values in batches:
+                if plan['binary_encoders']:
+                    _copy_columns_binary(cur, plan, column_values)
+                else:
+                    _copy_columns(cur, plan['copy_sql'], column_values)
+        else:
+            # Parse and plan the INSERT once, then send EXECUTEs a page at a time
+            cur.execute(plan['prepare_sql'])
+            for _columns, column_values in batches:
+                execute_batch(cur, plan['execute_sql'], zip(*column_values), page_size=COPY_BATCH_SIZE)
 
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise e
+    print(f"Finished migrating table: {plan['table_name']}")
+
+# Migrate one table in a worker process: a producer thread pages Airtable
+# while this thread streams the records into Postgres on the worker's connection
+def _migrate_one(table_name):
+    plan = TABLE_PLANS[table_name]
+    page_queue = queue.Queue(maxsize=PAGE_QUEUE_SIZE)
+    stop_event = threading.Event()
+    producer = threading.Thread(target=_produce_pages, args=(table_name, page_queue, stop_event), daemon=True)
+
+    producer.start()
+    try:
+        # One transaction per table
+        with _conn:
+            create_table_if_not_exists(_conn, plan)
+            # Records stream from the queue and are sent in COPY_BATCH_SIZE chunks
+            records = itertools.chain.from_iterable(_drain_pages(page_queue))
+            batches = (transform_data(plan, chunk) for chunk in _chunked(records, COPY_BATCH_SIZE))
+            insert_into_postgres(_conn, plan, batches, True)
     finally:
-        cur.close()
-        print(f'Finished migrating table: {table_name}')
-        conn.close()
+        stop_event.set()
+        # Don't wait out an in-flight Airtable request (and its retries) before
+        # reporting a failure; the daemon producer stops once that request returns
+        producer.join(timeout=PRODUCER_JOIN_TIMEOUT)
 
 # Run migration
 def migrate():
-    for table_name in config['tables'].keys():
-        create_table_if_not_exists(table_name)
-        records = get_airtable_data(table_name)
-        transformed_records = transform_data(table_name, records)
-        insert_into_postgres(table_name, transformed_records, True)
+    table_names = list(TABLE_PLANS.keys())
+
+    # Tables are independent, so each one runs its whole pipeline in parallel
+    with ProcessPoolExecutor(max_workers=min(len(table_names), TABLE_WORKERS),
+                             initializer=_init_worker, initargs=(_next_request_at,)) as executor:
+        list(executor.map(_migrate_one, table_names))
 
 if __name__ == '__main__':
     migrate()
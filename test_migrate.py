@@ -0,0 +1,83 @@
+import os
+import struct
+
+import pytest
+
+for module in ('psycopg2', 'requests', 'orjson', 'yaml', 'dotenv'):
+    pytest.importorskip(module)
+
+# migrate reads config.yaml relative to the working directory at import
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+import migrate
+
+PLAN = migrate._build_table_plan('Test Table', {
+    'Title': {'name': 'title', 'type': 'TEXT'},
+    'Opening Date': {'name': 'opening_date', 'type': 'DATE'},
+    'Display on Site': {'name': 'display_on_site', 'type': 'BOOLEAN'},
+})
+
+class RecordingCursor:
+    def __init__(self):
+        self.copies = []
+
+    def copy_expert(self, sql, buf):
+        self.copies.append((sql, buf.read()))
+
+# Decode a binary COPY stream into rows of raw field bytes (None for NULL)
+def read_binary_copy(data):
+    assert data[:11] == b'PGCOPY\n\xff\r\n\x00'
+    assert struct.unpack('!ii', data[11:19]) == (0, 0)
+    pos = 19
+    rows = []
+    while True:
+        (field_count,) = struct.unpack_from('!h', data, pos)
+        pos += 2
+        if field_count == -1:
+            break
+        row = []
+        for _ in range(field_count):
+            (length,) = struct.unpack_from('!i', data, pos)
+            pos += 4
+            if length == -1:
+                row.append(None)
+            else:
+                row.append(data[pos:pos + length])
+                pos += length
+        rows.append(row)
+    assert pos == len(data)
+    return rows
+
+def test_binary_copy_round_trip():
+    cur = RecordingCursor()
+    column_values = [['Café ☕', None], ['2024-03-01', '2000-01-01T10:00:00.000Z'], [True, None]]
+    migrate._copy_columns_binary(cur, PLAN, column_values)
+
+    [(sql, data)] = cur.copies
+    assert sql == PLAN['binary_copy_sql']
+    assert read_binary_copy(data) == [
+        ['Café ☕'.encode('utf-8'), struct.pack('!i', 8826), b'\x01'],
+        [None, struct.pack('!i', 0), None],
+    ]
+
+def test_binary_copy_falls_back_to_text_for_non_iso_dates():
+    cur = RecordingCursor()
+    migrate._copy_columns_binary(cur, PLAN, [['a\tb'], ['1/2/2024'], [False]])
+
+    assert cur.copies == [(PLAN['copy_sql'], 'a\\tb\t1/2/2024\tfalse\n')]
+
+@pytest.mark.parametrize('value', ['2024-1-2', '2024-01-02 garbage', '2024-W01-1', '20240102'])
+def test_date_encoder_rejects_anything_but_iso_dates(value):
+    with pytest.raises(ValueError):
+        migrate._encode_date(value)
+
+@pytest.mark.parametrize('value', ['false', 'no', '0', [False]])
+def test_binary_copy_falls_back_to_text_for_non_bool_booleans(value):
+    cur = RecordingCursor()
+    migrate._copy_columns_binary(cur, PLAN, [['a'], ['2024-03-01'], [value]])
+
+    [(sql, _data)] = cur.copies
+    assert sql == PLAN['copy_sql']
+
+def test_dict_values_are_rejected():
+    with pytest.raises(TypeError):
+        migrate._encode_text([{'url': 'x'}])